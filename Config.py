@@ -0,0 +1,10 @@
+import functools
+import json
+
+@functools.lru_cache(maxsize=1)
+def loadConfig() -> dict:
+    """ Returns the parsed contents of config.json (located in the working 
+        directory). The file is only read the first time this is called; every 
+        later call in the process returns the same dict."""
+    with open("config.json") as configFile:
+        return json.load(configFile)
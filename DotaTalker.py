@@ -1,10 +1,9 @@
 from steam.client import SteamClient
 from dota2.client import Dota2Client
-import json
+import Config
 
 
-with open("config.json") as configFile:
-    config: dict = json.load(configFile)
+config: dict = Config.loadConfig()
 
 steamClient = SteamClient()
 dotaClient = Dota2Client(steamClient)
@@ -7,76 +7,91 @@ from discord.message import Message
 from discord.user import User
 import re
 import math
-import json
+import Config
 import sqlite3
-import socketserver
-import threading
 import TheCoordinator as TC
 import asyncio
 
 class Master_Bot:
 
     def __init__(self):
-        with open("config.json") as configFile:
-            self.config: dict = json.load(configFile)
+        self.config: dict = Config.loadConfig()
+        self.deleteDelay: int = self.config.get('DELETE_DELAY')
 
         eventLoop = asyncio.new_event_loop()
-        self.coordinator: TC.Coordinator = TC.Coordinator(eventLoop)
 
-        self.con = sqlite3.connect('allUsers.db')
+        # allUsers.db is shared with the registration webserver (index.mjs),
+        # which writes to it from a separate process. WAL lets our reads run
+        # alongside its writes instead of blocking on the rollback journal.
+        self.con = sqlite3.connect('allUsers.db', timeout = 5.0)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.createIndexes()
         intents = discord.Intents.default()
         intents.members = True
         self.client = discord.Client(intents = intents, 
             loop=eventLoop)
+        self.coordinator: TC.Coordinator = TC.Coordinator(eventLoop, 
+            self.client)
         self.theGuild: Guild = None
 
         self.deleteMessage = ("\nThis message and your message will be deleted "
-            "in {time} seconds.").format(time = self.config.get('DELETE_DELAY'))
+            "in {time} seconds.").format(time = self.deleteDelay)
         self.registerEvents()
         
-        class MyTCPHandler(socketserver.BaseRequestHandler):
-
-            def __init__(self, request, client_address, server, 
-                    discordClient: discord.client.Client):
-                self.discordClient = discordClient
-                socketserver.BaseRequestHandler.__init__(self, request, 
-                    client_address, server)
-
-            def handle(self):
-                data = self.request.recv(1024).strip().decode('utf-8')
-                print("Just got "+data+" from the webserver")
-                self.discordClient.dispatch("steamIDFound", data)
-
-        class MyTCPServer(socketserver.ThreadingTCPServer):
-
-            def __init__(self, aTuple, discordClient):
-                self.discordClient = discordClient
-                socketserver.ThreadingTCPServer.__init__(self, aTuple, 
-                    MyTCPHandler)
-
-            def verify_request(self, _, client_adddress):
-                if client_adddress[0] == '127.0.0.1':
-                    return True
-                else:
-                    print(f"Attempted connection from {client_adddress[0]}")
-                    return False
-
-            def finish_request(self, request, client_address):
-                MyTCPHandler(request, client_address, self, self.discordClient)
-        
-        self.socketPipe = MyTCPServer(
-            ("localhost", self.config.get('pipePort')), self.client)
-
-        self.serverThread = threading.Thread(
-            target=self.socketPipe.serve_forever)
-        self.serverThread.start()
+        # The registration webserver reports new registrants over a local TCP
+        # pipe. Serving it from the bot's own event loop means the handler can
+        # dispatch straight into the discord client without a server thread.
+        self.socketPipe: asyncio.AbstractServer = eventLoop.run_until_complete(
+            asyncio.start_server(self.handlePipeConnection, "127.0.0.1", 
+                self.config.get('pipePort')))
         
         self.client.run(self.config.get('CLIENT_KEY'))
 
-    def escapeString(self, string: str) -> str:
-        """ Creates a copy of the given string where all double quotation marks 
-            are replaced with single quotation marks."""
-        return string.replace('\"', '\'')
+    async def handlePipeConnection(self, reader: asyncio.StreamReader, 
+            writer: asyncio.StreamWriter):
+        """ Handles a connection from the registration webserver. It writes 
+            the discord id of a newly registered user and then closes the 
+            connection, so the message is everything up to EOF. The server 
+            only listens on 127.0.0.1, so every connection is local."""
+        try:
+            data = (await reader.read()).strip().decode('utf-8')
+            # the webserver's startup check connects without sending anything
+            if data:
+                print("Just got "+data+" from the webserver")
+                self.client.dispatch("steamIDFound", data)
+        except (ConnectionError, UnicodeDecodeError) as e:
+            print(f"Bad connection from the webserver: {e!r}")
+        finally:
+            writer.close()
+
+    def createIndexes(self):
+        """ Creates the indexes the bot's lookups rely on if any are missing,
+            and then runs ANALYZE so the planner has statistics for them. Every
+            lookup filters users by discord_id, mod_notes by registrant_id or 
+            mod_id, and vouches by voucher and vouchee. The tables themselves 
+            are created outside this repo, so if they are missing or the 
+            database stays locked this is reported instead of stopping the 
+            bot."""
+        indexes = {
+            "idx_users_discord": "users(discord_id)",
+            "idx_mod_notes_registrant": "mod_notes(registrant_id, result)",
+            "idx_mod_notes_mod": "mod_notes(mod_id, registrant_id)",
+            "idx_vouches_voucher": "vouches(voucher_id, vouchee_id)"}
+        try:
+            existing = {name for (name,) in self.con.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+            missing = [(name, columns) for (name, columns) in indexes.items()
+                       if name not in existing]
+            if not missing:
+                return
+            with self.con:
+                for (name, columns) in missing:
+                    self.con.execute(
+                        f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+            self.con.execute("ANALYZE")
+        except sqlite3.OperationalError as e:
+            print(f"Could not create the lookup indexes: {e}")
 
     def modResults(self, user: User) -> tuple[int, int, int]:
         """ Returns (A, D, W) where 
@@ -85,25 +100,20 @@ class Master_Bot:
                 W is the number of votes still in process
             of the registered mods in the table mod_notes"""
         cursor = self.con.cursor()
-        rows = cursor.execute(f"""SELECT result FROM mod_notes 
-            WHERE registrant_id = {user.id}""").fetchall()
+        (A, D, W) = cursor.execute("""SELECT
+                COALESCE(SUM(result = 1), 0),
+                COALESCE(SUM(result = 0), 0),
+                COALESCE(SUM(result IS NULL OR result NOT IN (0, 1)), 0)
+            FROM mod_notes WHERE registrant_id = ?""", (user.id,)).fetchone()
         cursor.close()
-        (A, D, W) = (0, 0, 0)
-        for row in rows:
-            if row[0] == 0:
-                D += 1
-            elif row[0] == 1:
-                A += 1
-            else:
-                W += 1
         return (A, D, W)
 
     def itemInTable(self, table: str, field: str, value):
         """ Returns true if the given value is in the given table in the given 
             field."""
         cursor = self.con.cursor()
-        row = cursor.execute(f"""SELECT * FROM {table} 
-            WHERE {field} = {value} LIMIT 1""").fetchone()
+        row = cursor.execute(f"""SELECT 1 FROM {table} 
+            WHERE {field} = ? LIMIT 1""", (value,)).fetchone()
         cursor.close()
         if row:
             return True
@@ -117,9 +127,9 @@ class Master_Bot:
             issued registrant will not be given a new one. """
         sent: Message
         cursor = self.con.cursor()
-        (assignedRegistrant,) = tuple(cursor.execute(f"""
-            SELECT (assignedRegistrant) FROM users WHERE discord_id = 
-            {message.author.id}""").fetchone())
+        (assignedRegistrant,) = tuple(cursor.execute("""
+            SELECT (assignedRegistrant) FROM users WHERE discord_id = ?""", 
+            (message.author.id,)).fetchone())
         cursor.close()
         if message.channel.name != "mod-station":
             sent = await message.reply(("<@{name}>: please use the <#{mod}> "
@@ -135,13 +145,13 @@ class Master_Bot:
                 + self.deleteMessage)
         else:
             cursor = self.con.cursor()
-            row = cursor.execute(f"""
+            row = cursor.execute("""
                 SELECT (discord_id) FROM users WHERE 
                     modsRemaining > 0
                     AND NOT EXISTS (SELECT 1 FROM mod_notes WHERE 
-                        mod_id = {message.author.id} AND 
+                        mod_id = ? AND 
                         registrant_id = discord_id)
-                ORDER BY dateCreated ASC""").fetchone()
+                ORDER BY dateCreated ASC""", (message.author.id,)).fetchone()
             cursor.close()
             if row == None:
                 sent = await message.reply(("<@{name}>: either the registration"
@@ -150,26 +160,23 @@ class Master_Bot:
                     + self.deleteMessage)
             else: 
                 assignedRegistrant = row[0]
-                self.con.execute(f"""UPDATE users 
-                    SET modsRemaining = modsRemaining - 1 
-                    WHERE discord_id = {assignedRegistrant}""")
-                self.con.commit()
-                self.con.execute(f"""UPDATE users SET assignedRegistrant = 
-                    {assignedRegistrant} WHERE discord_id = {message.author.id}
-                    """)
-                self.con.commit()
-                self.con.execute(f"""INSERT INTO mod_notes 
-                    (request_id, mod_id, registrant_id) VALUES 
-                    ({message.id}, {message.author.id}, {assignedRegistrant})
-                    """)
-                self.con.commit()
+                with self.con:
+                    self.con.execute("""UPDATE users 
+                        SET modsRemaining = modsRemaining - 1 
+                        WHERE discord_id = ?""", (assignedRegistrant,))
+                    self.con.execute("""UPDATE users SET assignedRegistrant = ?
+                        WHERE discord_id = ?""", 
+                        (assignedRegistrant, message.author.id))
+                    self.con.execute("""INSERT INTO mod_notes 
+                        (request_id, mod_id, registrant_id) VALUES (?, ?, ?)""",
+                        (message.id, message.author.id, assignedRegistrant))
                 sent = await message.reply(("<@{name}>: you are now assigned "
                     "the registrant <@{name2}>").format(
                         name = message.author.id, 
                         name2 = assignedRegistrant) 
                     + self.deleteMessage)
-        await message.delete(delay = self.config.get('DELETE_DELAY'))
-        await sent.delete(delay = self.config.get('DELETE_DELAY'))
+        await message.delete(delay = self.deleteDelay)
+        await sent.delete(delay = self.deleteDelay)
 
     async def modDecisionCommand(self, message: Message):
         """ The $approve and $reject commands are used by mods with respect to 
@@ -184,19 +191,19 @@ class Master_Bot:
                 "channel").format(name = message.author.id, 
                     mod = int(self.config.get('MOD_CHANNEL_ID')))
                 + self.deleteMessage)
-            await message.delete(delay = self.config.get('DELETE_DELAY'))
+            await message.delete(delay = self.deleteDelay)
         else: 
             cursor = self.con.cursor()
-            registrant = cursor.execute(f"""
+            registrant = cursor.execute("""
                     SELECT assignedRegistrant FROM users 
-                    WHERE discord_id = {message.author.id}""").fetchone()[0]
+                    WHERE discord_id = ?""", (message.author.id,)).fetchone()[0]
             if registrant == None:
                 sent = await message.reply(("<@{name}>: you do not currently "
                     "have an assigned registrant. Please use the "
                     "\"$pollRegistration\" command to receive a new "
                     "registrant.").format(name = message.author.id) 
                     + self.deleteMessage)
-                await message.delete(delay = self.config.get('DELETE_DELAY'))
+                await message.delete(delay = self.deleteDelay)
             else: 
                 result = 1 if message.content.startswith("$approve") else 0
                 reMatch = re.match("^(\$approve|\$reject)( *)(.*)", 
@@ -209,18 +216,16 @@ class Master_Bot:
                             Bender = int(self.config.get('BENDER_ID')))
                         + self.deleteMessage)
                     await message.delete(
-                        delay = self.config.get('DELETE_DELAY'))
+                        delay = self.deleteDelay)
                 else: 
-                    self.con.execute(f"""UPDATE mod_notes 
-                        SET notes = \"{self.escapeString(message.content)}\", 
-                                result = {result},
-                                resultMessage_id = {message.id}
-                            WHERE mod_id = {message.author.id}""")
-                    self.con.commit()
-                    self.con.execute(f"""UPDATE users 
-                            SET assignedRegistrant = NULL 
-                            WHERE discord_id = {message.author.id}""")
-                    self.con.commit()
+                    with self.con:
+                        self.con.execute("""UPDATE mod_notes 
+                            SET notes = ?, result = ?, resultMessage_id = ?
+                                WHERE mod_id = ?""", (message.content, result, 
+                                    message.id, message.author.id))
+                        self.con.execute("""UPDATE users 
+                                SET assignedRegistrant = NULL 
+                                WHERE discord_id = ?""", (message.author.id,))
                     theUser: Member = self.theGuild.get_member(registrant)
                     results = self.modResults(theUser)
                     modRequirements = math.ceil(
@@ -239,12 +244,13 @@ class Master_Bot:
                             "{num} moderators and are unable to register. If "
                             "you think this was made in error, contact "
                             "<@{Bender}>").format(name = registrant, 
+                                num = results[1],
                                 Bender = int(self.config.get('BENDER_ID'))))
                     sent = await message.reply(("<@{name}>: thank you for "
                         "taking the time to review this user! Feel free to use "
                         "the \$pollRegistration command to grab another when "
                         "you're ready.").format(name = message.author.id))
-        await sent.delete(delay = self.config.get('DELETE_DELAY'))
+        await sent.delete(delay = self.deleteDelay)
 
     async def vouchCommand(self, message: Message):
         """ The $vouch command allows a user to vouch for another user. This 
@@ -258,8 +264,8 @@ class Master_Bot:
                 "channel").format(name = message.author.id, 
                     vouch = int(self.config.get('VOUCH_CHANNEL_ID')))
                 + self.deleteMessage)
-            await sent.delete(delay = self.config.get('DELETE_DELAY'))
-            await message.delete(delay = self.config.get('DELETE_DELAY'))
+            await sent.delete(delay = self.deleteDelay)
+            await message.delete(delay = self.deleteDelay)
         elif reMatch == None:
             sent = await message.reply(("<@{name}>: incorrect format. To vouch "
                 "for someone, your post should look something like '$vouch "
@@ -268,8 +274,8 @@ class Master_Bot:
                     name = message.author.id, 
                     Bender = int(self.config.get('BENDER_ID')))
                 + self.deleteMessage)
-            await sent.delete(delay = self.config.get('DELETE_DELAY'))
-            await message.delete(delay = self.config.get('DELETE_DELAY'))
+            await sent.delete(delay = self.deleteDelay)
+            await message.delete(delay = self.deleteDelay)
         else:
             voucheeID = int(reMatch.group(2))
             theVouchee: Member = self.theGuild.get_member(voucheeID)
@@ -280,40 +286,44 @@ class Master_Bot:
                         name = message.author.id)
                     + self.deleteMessage)
                     
-                await message.delete(delay = self.config.get('DELETE_DELAY'))
+                await message.delete(delay = self.deleteDelay)
             elif theVouchee == theVoucher:
                 sent = await message.reply(("<@{name}>: you cannot vouch for "
                     "yourself.").format(name = message.author.id) 
                     + self.deleteMessage)
-                await message.delete(delay = self.config.get('DELETE_DELAY'))
+                await message.delete(delay = self.deleteDelay)
             else: 
                 cursor = self.con.cursor()
-                row = cursor.execute(f"""SELECT * FROM vouches WHERE 
-                    voucher_id = {theVoucher.id} AND 
-                    vouchee_id = {voucheeID}""").fetchone()
+                row = cursor.execute("""SELECT 1 FROM vouches WHERE 
+                    voucher_id = ? AND vouchee_id = ?""", 
+                    (theVoucher.id, voucheeID)).fetchone()
                 cursor.close()
                 if row:
-                    self.con.execute(f"""UPDATE vouches 
-                        SET notes = \"{self.escapeString(message.content)}\" 
-                        WHERE voucher_id = {theVoucher.id} AND
-                            vouchee_id = {voucheeID}""")
+                    self.con.execute("""UPDATE vouches SET notes = ? 
+                        WHERE voucher_id = ? AND vouchee_id = ?""", 
+                        (message.content, theVoucher.id, voucheeID))
                     self.con.commit()
                     sent = await message.reply(("<@{name}>: you have already "
                         "vouched for <@{name2}>. I will update your note with "
                         "your latest message. This message will be deleted in "
                         "{delay} seconds.").format(name = message.author.id, 
                             name2 = voucheeID, 
-                            delay = self.config.get('DELETE_DELAY')))
+                            delay = self.deleteDelay))
                 else: 
-                    self.con.execute(f"""UPDATE users 
-                        SET timesVouched = timesVouched + 1 
-                        WHERE discord_id = {voucheeID}
-                    """)
+                    with self.con:
+                        self.con.execute("""UPDATE users 
+                            SET timesVouched = timesVouched + 1 
+                            WHERE discord_id = ?""", (voucheeID,))
+                        self.con.execute("""INSERT INTO vouches 
+                            (vouch_id, vouchee_id, voucher_id, notes)
+                            VALUES (?, ?, ?, ?)""", (message.id, voucheeID, 
+                                theVoucher.id, message.content))
                     cursor = self.con.cursor()
-                    vouches = cursor.execute(f"""SELECT timesVouched FROM users 
-                        WHERE discord_id = {voucheeID}""").fetchall()
+                    (timesVouched,) = cursor.execute("""SELECT timesVouched 
+                        FROM users WHERE discord_id = ?""", 
+                        (voucheeID,)).fetchone()
                     cursor.close()
-                    if len(vouches) == self.config.get('VOUCH_REQUIREMENT'):
+                    if timesVouched == self.config.get('VOUCH_REQUIREMENT'):
                         await theVouchee.add_roles(discord.utils.get(
                             self.theGuild.roles, name = "Vouched"))
                         await theVouchee.send(("<@{name}>: you "
@@ -322,17 +332,13 @@ class Master_Bot:
                             "queue, but only among other vouched "
                             "users.").format(
                                 name = theVouchee.id))
-                    self.con.execute(f"""INSERT INTO vouches 
-                        (vouch_id, vouchee_id, voucher_id, notes)
-                        VALUES ({message.id}, {voucheeID}, {theVoucher.id}, 
-                            \"{self.escapeString(message.content)}\")""")
                     sent = await message.reply(("<@{name}>: acknowledged, thank"
                         " you for vouching <@{name2}>. This message will be "
                         "deleted in {delay} seconds.").format(
                             name = message.author.id, name2 = voucheeID, 
-                            delay = self.config.get('DELETE_DELAY'))
+                            delay = self.deleteDelay)
                         )
-        await sent.delete(delay = self.config.get('DELETE_DELAY'))
+        await sent.delete(delay = self.deleteDelay)
 
     async def setRatingCommand(self, message: Message):
         sent: Message
@@ -341,9 +347,9 @@ class Master_Bot:
         if message.channel.name != "mod-station":
             sent = await message.reply(("<@{name}>: please use the <#{mod}> "
                 "channel").format(name = message.author.id, 
-                    vouch = int(self.config.get('MOD_CHANNEL_ID')))
+                    mod = int(self.config.get('MOD_CHANNEL_ID')))
                 + self.deleteMessage)
-            await sent.delete(delay = self.config.get('DELETE_DELAY'))
+            await sent.delete(delay = self.deleteDelay)
         elif reMatch == None:
             sent = await message.reply(("<@{name}>: incorrect format. To set "
                 "the rank of a user, your message should look like $setrank "
@@ -351,22 +357,22 @@ class Master_Bot:
                     name = message.author.id, 
                     Bender = int(self.config.get('BENDER_ID')))
                 + self.deleteMessage)
-            await sent.delete(delay = self.config.get('DELETE_DELAY'))
+            await sent.delete(delay = self.deleteDelay)
         else:
             userID = int(reMatch.group(2))
             rating = int(reMatch.group(3))
-            self.con.execute(f"""UPDATE users SET rating = {rating}
-                WHERE discord_id = {userID}""")
+            self.con.execute("""UPDATE users SET rating = ?
+                WHERE discord_id = ?""", (rating, userID))
             self.con.commit()
             sent = await message.reply("<@{name}>: acknowledged, thank you!".
                 format(name = message.author.id))
-        await sent.delete(delay = self.config.get('DELETE_DELAY'))
+        await sent.delete(delay = self.deleteDelay)
 
     async def queueCommand(self, message: Message):
         sent: Message
         cursor = self.con.cursor()
-        rating: int = cursor.execute(f"""SELECT rating FROM users 
-            WHERE discord_id = {message.author.id}""").fetchone()[0]
+        rating: int = cursor.execute("""SELECT rating FROM users 
+            WHERE discord_id = ?""", (message.author.id,)).fetchone()[0]
         cursor.close()
         if rating == None:
             sent = await message.reply(("<@{name}>: the mods haven't assigned "
@@ -378,8 +384,8 @@ class Master_Bot:
                 "queueing with rating {rating}").format(
                     name = message.author.id, rating = rating) 
                 + self.deleteMessage)
-        await message.delete(delay = self.config.get('DELETE_DELAY'))
-        await sent.delete(delay = self.config.get('DELETE_DELAY'))
+        await message.delete(delay = self.deleteDelay)
+        await sent.delete(delay = self.deleteDelay)
 
     def registerEvents(self):
 
@@ -403,24 +409,27 @@ class Master_Bot:
             """ This function is called whenever a message is read by this 
                 bot"""
             
-            # Ignore bot's own messages
-            if message.author == self.client.user:
+            content = message.content
+
+            # Ignore bot's own messages, and skip the command checks below for
+            # the ordinary chat messages that make up most of the traffic
+            if (message.author == self.client.user or 
+                    not content.startswith("$")):
                 pass
 
-            elif message.content.startswith("$pollRegistration"):
+            elif content.startswith("$pollRegistration"):
                 await self.pollRegistrationCommand(message)
                 
-            elif (message.content.startswith("$approve") or 
-                    message.content.startswith("$reject")):
+            elif content.startswith(("$approve", "$reject")):
                 await self.modDecisionCommand(message)
 
-            elif message.content.startswith("$vouch"):
+            elif content.startswith("$vouch"):
                 await self.vouchCommand(message)
 
-            elif message.content.startswith("$setrating"):
+            elif content.startswith("$setrating"):
                 await self.setRatingCommand(message)
 
-            elif message.content.startswith("$queue"):
+            elif content.startswith("$queue"):
                 await self.queueCommand(message)
 
             # TODO: $queue, $info
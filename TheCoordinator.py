@@ -1,15 +1,41 @@
 from asyncio.events import TimerHandle
 from typing import Callable
-import Master_Bot as MB
-import json
+import Config
 import time
 import itertools
+import functools
 import math
 import asyncio
 import discord
+import numpy as np
+
+# How many candidate player pools __create scores per vectorized pass. Each 
+# pool is scored over all 252 splits of its 10 players, so one batch of 64 
+# pools keeps the temporary rating arrays to a few megabytes.
+POOLS_PER_BATCH = 64
+
+# Tolerance, relative to the largest rating in the pool, within which two 
+# game-imbalance scores count as tied. Vectorized means round differently from
+# the scalar formula, so exact ties can differ in the last few bits.
+SCORE_RTOL = 1e-9
+
+@functools.lru_cache(maxsize=None)
+def splitIndices(n: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Returns (idxA, idxB) where row k of idxA and idxB are the indices of 
+        the first and second team in the k-th way of splitting n players into
+        two teams, with idxA holding int(n/2) players. The rows are in the 
+        same order as itertools.combinations(range(n), int(n/2))."""
+    combos = tuple(itertools.combinations(range(n), int(n / 2)))
+    idxA = np.array(combos, dtype=np.intp).reshape(len(combos), int(n / 2))
+    idxB = np.array([[i for i in range(n) if i not in combo] 
+        for combo in combos], dtype=np.intp).reshape(len(combos), 
+            n - int(n / 2))
+    return (idxA, idxB)
 
 class User:
 
+    __slots__ = ('discordID', 'rating', 'entranceTime', 'eventHandle')
+
     def __init__(self, discordID: int, rating: int):
         """ Initializes the instance variables of the User class. This includes:
                 discordID:          the discord id of the associated User
@@ -37,8 +63,12 @@ class Coordinator:
             directory), and creates instance variables for storing the discord
             info of the users, a queue of the users in FIFO order, and a sorted
             list of all the users by their rating."""
-        with open("config.json") as configFile:
-            self.config: dict = json.load(configFile)
+        self.config: dict = Config.loadConfig()
+        # matchmaking parameters, read on every imbalance evaluation
+        self.pNorm: float = self.config.get('pNorm')
+        self.qNorm: float = self.config.get('qNorm')
+        self.alpha: float = self.config.get('alpha')
+        self.lookAround: int = self.config.get('lookAround')
 
         self.usersByID: dict[int, User] = {}
         self.usersFIFO: list[User] = []
@@ -58,16 +88,20 @@ class Coordinator:
         curStart = 0
         curEnd = len(listOfUsers)
         curIdx = int((curStart + curEnd)/2)
+        userKey = key(user)
 
         # recurse until we can recurse no further or we have found an equal key
-        while(curStart != curEnd and key(listOfUsers[curIdx]) != key(user)):
-            if key(listOfUsers[curIdx]) < key(user):
+        while curStart != curEnd:
+            curKey = key(listOfUsers[curIdx])
+            if curKey == userKey:
+                break
+            elif curKey < userKey:
                 curStart = curIdx+1
             else:
                 curEnd = curIdx
             curIdx = int((curStart + curEnd)/2)
         # if user is not in listOfUsers or if we have found the user itself
-        if (curIdx == len(listOfUsers) or key(listOfUsers[curIdx]) != key(user) 
+        if (curIdx == len(listOfUsers) or key(listOfUsers[curIdx]) != userKey 
             or listOfUsers[curIdx] == user): 
             return curIdx
         else:
@@ -75,13 +109,13 @@ class Coordinator:
             # to determine whether or not user is among the list listOfUsers
             prevIdx = curIdx
             curIdx -= 1
-            while(curIdx >= 0 and key(listOfUsers[curIdx]) == key(user)):
+            while(curIdx >= 0 and key(listOfUsers[curIdx]) == userKey):
                 if listOfUsers[curIdx] == user:
                     return curIdx
                 curIdx -= 1
             curIdx = prevIdx + 1
             while(curIdx < len(listOfUsers) and 
-                key(listOfUsers[curIdx]) == key(user)):
+                key(listOfUsers[curIdx]) == userKey):
                 if listOfUsers[curIdx] == user:
                     return curIdx
                 curIdx += 1
@@ -94,57 +128,37 @@ class Coordinator:
             is not enough users above, it will find extra below to make up the 
             difference, and vice-versa. """
         idx = self.findIndexBS(user, self.usersByRating, User.getRating)
-        preferredStart = idx - int(self.config.get('lookAround')/2)
+        preferredStart = idx - int(self.lookAround/2)
         startCut = 0 if preferredStart > 0 else -preferredStart
-        preferredEnd = idx + int(self.config.get('lookAround')/2)
+        preferredEnd = idx + int(self.lookAround/2)
         endCut = (0 if preferredEnd < len(self.usersByRating) 
                     else preferredEnd - len(self.usersByRating) + 1)
         start = max(preferredStart - endCut, 0)
         end = min(preferredEnd + startCut, len(self.usersByRating) - 1)
         return self.usersByRating[start:idx] + self.usersByRating[idx+1:end+1]
 
-    def gameImbalance(self, teamA: tuple[User, ...], 
-                            teamB: tuple[User, ...]) -> float:
-        """ Calculates the game-imbalance of the given teams.
+    def gameImbalanceBatch(self, teamsA: np.ndarray, 
+                                 teamsB: np.ndarray) -> np.ndarray:
+        """ Calculates the game-imbalance of many candidate games at once.
+            teamsA and teamsB are arrays of ratings with one candidate game per
+            row along the last axis, e.g. of shape (K, nA) and (K, nB). Returns
+            an array of shape (K,) holding the imbalance of each game. Any 
+            number of leading axes is allowed.
             See https://www.ifaamas.org/Proceedings/aamas2017/pdfs/p1073.pdf"""
-        nA = len(teamA)
-        nB = len(teamB)
-        pNorm = self.config.get('pNorm')
-        qNorm = self.config.get('qNorm')
-
-        teamASkills = tuple(map(lambda x : x.getRating(), teamA))
-        teamBSkills = tuple(map(lambda x : x.getRating(), teamB))
-        avgSkill = (sum(teamASkills) + sum(teamBSkills))/(nA + nB)
-
-        teamAPoweredSkills = tuple(map(lambda x : x ** pNorm, 
-                                    teamASkills))
-        teamASkillNormed = (sum(teamAPoweredSkills) / nA) ** (1 / pNorm)
-        teamBPoweredSkills = tuple(map(lambda x : x ** pNorm, 
-                                    teamBSkills))
-        teamBSkillNormed = (sum(teamBPoweredSkills) / nB) ** (1 / pNorm)
-
-        poweredVariances = tuple(map(
-            lambda x : abs(x.getRating() - avgSkill) ** qNorm, teamA + teamB))
-        normedVariance = (sum(poweredVariances) / (nA + nB)) ** (1 / qNorm)
+        pNorm = self.pNorm
+        qNorm = self.qNorm
 
-        return (normedVariance + 
-            self.config.get('alpha') * abs(teamASkillNormed - teamBSkillNormed))
+        allSkills = np.concatenate((teamsA, teamsB), axis = -1)
+        avgSkill = allSkills.mean(axis = -1, keepdims = True)
 
-    def bestGameUsingExactlyThesePlayers(self,
-            users: list[User]) -> (tuple[tuple[User, ...], tuple[User, ...]]):
-        """ WARNING: This function has runtime exponential in the length of 
-            users. It tries every choice of possible 2 team games between the 
-            list of users"""
-        bestGame = None
-        bestScore = math.inf
+        teamASkillNormed = (teamsA ** pNorm).mean(axis = -1) ** (1 / pNorm)
+        teamBSkillNormed = (teamsB ** pNorm).mean(axis = -1) ** (1 / pNorm)
 
-        for teamA in itertools.combinations(users, int(len(users) / 2)):
-            teamB = tuple(user for user in users if user not in teamA)
-            score = self.gameImbalance(teamA, teamB)
-            if score < bestScore:
-                bestScore = score
-                bestGame = (teamA, teamB)
-        return bestGame
+        normedVariance = (np.abs(allSkills - avgSkill) ** qNorm).mean(
+            axis = -1) ** (1 / qNorm)
+
+        return (normedVariance + 
+            self.alpha * np.abs(teamASkillNormed - teamBSkillNormed))
 
     def approxBestGameUsingExactlyThesePlayers(self, users: list[User]) -> (
             tuple[tuple[User, ...], tuple[User, ...]]):
@@ -183,7 +197,12 @@ class Coordinator:
             self.__create()
 
     def delete(self, discordID: int):
-        self.eventLoop.call_soon(self.__delete, self.usersByID.get(discordID))
+        self.eventLoop.call_soon(self.__deleteByID, discordID)
+
+    def __deleteByID(self, discordID: int):
+        """ This looks up the queued User with the given discordID when the 
+            deletion runs, so that it sees any insert scheduled before it."""
+        self.__delete(self.usersByID.get(discordID))
 
     def __delete(self, user: User):
         """ This deletes user from the queue and usersByRating."""
@@ -208,26 +227,57 @@ class Coordinator:
             self.waitingForTen = True
             return
         theUser = self.usersFIFO[0]
-        thePool = self.findUserPool(theUser)
+        players = self.findUserPool(theUser) + [theUser]
+        # The ratings are gathered once into a contiguous array, and each 
+        # candidate game is a row of indices into it with theUser always last.
+        ratings = np.array([user.getRating() for user in players], 
+            dtype = np.float64)
+        # The candidate pools are enumerated lazily, one batch at a time, so 
+        # only POOLS_PER_BATCH of them are ever materialized.
+        ninePlayerPools = itertools.combinations(range(len(players) - 1), 9)
+        tolerance = SCORE_RTOL * max(ratings.max(), 1.0)
+        (idxA, idxB) = splitIndices(10)
         bestGame = None
         bestScore = math.inf
-        for ninePlayers in itertools.combinations(thePool, 9):
-            (teamA, teamB) = self.bestGameUsingExactlyThesePlayers(
-                list(ninePlayers) + [theUser])
-            curScore = self.gameImbalance(teamA, teamB)
-            if curScore < bestScore: 
-                bestGame = (teamA, teamB)
-                bestScore = curScore
-        for user in bestGame[0] + bestGame[1]:
+        while True:
+            batch = tuple(
+                ninePlayers + (len(players) - 1,) for ninePlayers in 
+                itertools.islice(ninePlayerPools, POOLS_PER_BATCH))
+            if not batch:
+                break
+            pools = np.array(batch, dtype = np.intp)
+            games = ratings[pools]
+            scores = self.gameImbalanceBatch(games[:, idxA], 
+                games[:, idxB]).ravel()
+            batchScore = scores.min()
+            # the first game within tolerance of the minimum wins, as in a 
+            # strict-less-than scan over the games in order
+            if batchScore < bestScore - tolerance:
+                bestScore = batchScore
+                (poolIdx, splitIdx) = divmod(
+                    int(np.flatnonzero(scores <= batchScore + tolerance)[0]), 
+                    len(idxA))
+                pool = pools[poolIdx]
+                bestGame = (tuple(players[i] for i in pool[idxA[splitIdx]]),
+                            tuple(players[i] for i in pool[idxB[splitIdx]]))
+        gameUsers = bestGame[0] + bestGame[1]
+        for user in gameUsers:
             self.__delete(user)
         self.discordClient.dispatch("game_created", 
-            list(map(lambda x : x.discordID, bestGame[0] + bestGame[1])))
+            [user.discordID for user in gameUsers])
         return bestGame
 
 def test():
     import random
+
+    class TestClient:
+        """ Stands in for the discord client, printing the events that the
+            coordinator dispatches instead of handling them."""
+        def dispatch(self, event: str, *args):
+            print(event, *args)
+
     eventLoop = asyncio.new_event_loop()
-    coordinator = Coordinator(eventLoop)
+    coordinator = Coordinator(eventLoop, TestClient())
     delay = 0
     for i in range(500):
         rating = max(int(random.normalvariate(2500, 1000)), 0)